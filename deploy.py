@@ -1,5 +1,4 @@
-#!/usr/bin/env python
-# -*- coding: utf-8; -*-
+#!/usr/bin/env python3
 
 """Automate deploying Slacker Cow updates.
 
@@ -9,118 +8,258 @@ of the other components, such as Redis and so on. But since those should rarely
 (if ever) need to be altered, that's not a real concern, either.
 """
 
-from __future__ import print_function
-
+import concurrent.futures
+import functools
+import hashlib
 import os
 import re
-import StringIO
+import shutil
 import sys
 import subprocess
-import tempfile
 
 # Location of the kubectl template
 FRONTEND_TEMPLATE = 'kubecfg/frontend-controller.template.json'
+# Name of the hubot image in the container registry
+IMAGE = 'gcr.io/slacker-cow/hubot'
 # String to replace with the new version stamp
-VERSION_REPLACEMENT = 'XXX-REPLACE-WITH-NEW-VERSION-XXX'
+VERSION_REPLACEMENT = b'XXX-REPLACE-WITH-NEW-VERSION-XXX'
 # String to replace with the Slack API token
-SLACK_REPLACEMENT = 'XXX-REPLACE-WITH-SLACK-TOKEN-XXX'
+SLACK_REPLACEMENT = b'XXX-REPLACE-WITH-SLACK-TOKEN-XXX'
 # Path to file containing the Slack API token to use
 SLACK_TOKEN_FILE = '.slack_token'
 # String to replace with the Jenkins API token
-JENKINS_API_REPLACEMENT = 'XXX-REPLACE-WITH-JENKINS-API-TOKEN-XXX'
+JENKINS_API_REPLACEMENT = b'XXX-REPLACE-WITH-JENKINS-API-TOKEN-XXX'
 # Path to file containing the Jenkins API token to use
 JENKINS_API_TOKEN_FILE = '.jenkins_api_token'
-# Regex to find the current version from kubectl's output
-POD_ID_MATCH = re.compile('frontend-v\d+-[^\s]+', re.MULTILINE)
+# How long `kubectl rolling-update` waits after each scaling step.  Its
+# default of a minute is meant for fleets; we only run a single replica.
+UPDATE_PERIOD = '10s'
+# Files and directories, relative to the repo root, the image is built from
+IMAGE_SOURCES = ['Dockerfile', 'hubot']
+# Path to file recording the source digest of the last image pushed
+LAST_BUILD_DIGEST_FILE = '.last_build_digest'
+# Regex matching any of the strings to replace in the template
+SUBSTITUTION_MATCH = re.compile(
+    b'(XXX-REPLACE-WITH-(?:NEW-VERSION|SLACK-TOKEN|JENKINS-API-TOKEN)-XXX)')
+# Label selector matching the frontend replication controller
+FRONTEND_SELECTOR = 'name=frontend'
+
+# How much command output to read at a time
+READ_SIZE = 65536
+
+# Pre-split templates (see _load_template), keyed by (path, mtime, size) of
+# the template file
+_TEMPLATE_CACHE = {}
+
+
+def get_source_digest():
+    """Return a digest of the checked-in files the image is built from.
+
+    This covers the paths and working-tree contents of every file git
+    tracks under IMAGE_SOURCES; untracked files are ignored.
+    """
+    filenames = run_command(['git', 'ls-files', '-z', '--'] + IMAGE_SOURCES,
+                            echo=False)
+    digest = hashlib.sha256()
+    for filename in filenames.split(b'\0'):
+        if not filename or not os.path.isfile(filename):
+            continue
+        with open(filename, 'rb') as source_file:
+            contents = source_file.read()
+        digest.update(filename + b'\0')
+        digest.update(hashlib.sha256(contents).digest())
+    return digest.hexdigest()
+
+
+def get_remote_digest():
+    """Return the registry's digest for IMAGE, or None if it has none."""
+    try:
+        digest = run_command(
+            ['gcloud', 'container', 'images', 'describe', IMAGE,
+             '--format=value(image_summary.digest)'],
+            echo=False).strip().decode('ascii')
+    except subprocess.CalledProcessError:
+        return None
+    return digest or None
+
+
+def image_is_pushed(remote_digest):
+    """Return whether the local build of IMAGE is already in the registry.
+
+    A freshly built image has no registry digests until it is pushed, but
+    one that came entirely out of docker's layer cache keeps the digest it
+    was last pushed or pulled under; if that matches remote_digest (see
+    get_remote_digest), there is nothing to upload.
+    """
+    if remote_digest is None:
+        return False
+    local_digests = run_command(
+        ['docker', 'inspect', '--format', '{{join .RepoDigests " "}}', IMAGE],
+        echo=False).decode('ascii').split()
+    return '%s@%s' % (IMAGE, remote_digest) in local_digests
 
 
 def rebuild_image():
-    run_command(['docker', 'build', '-t', 'gcr.io/slacker-cow/hubot', '.'])
-    run_command(['gcloud', 'docker', 'push', 'gcr.io/slacker-cow/hubot'])
+    """Build and push the hubot image, unless its sources are unchanged."""
+    source_digest = get_source_digest()
+    try:
+        with open(LAST_BUILD_DIGEST_FILE) as digest_file:
+            last_digest = digest_file.read().strip()
+    except OSError:
+        last_digest = None
+    if source_digest == last_digest:
+        print('Image sources unchanged since the last push; not rebuilding.')
+        return
+    # The registry lookup doesn't depend on the build, so hide it under it.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        remote_digest = executor.submit(get_remote_digest)
+        run_command(['docker', 'build', '-t', IMAGE, '.'])
+    if image_is_pushed(remote_digest.result()):
+        print('Image is already in the registry; not pushing.')
+    else:
+        run_command(['gcloud', 'docker', 'push', IMAGE])
+    with open(LAST_BUILD_DIGEST_FILE, 'w') as digest_file:
+        digest_file.write(source_digest + '\n')
+
+
+def format_version(prefix, number):
+    """Return the version name for a prefix and version number."""
+    return '%s-v%d' % (prefix, number)
 
 
-def get_version(s):
-    """Return the actual version from a pod string.
+@functools.lru_cache(maxsize=1)
+def _fetch_controller_name():
+    """Return the name of the frontend replication controller.
 
-    kubectl, when give a string like foobarbaz, actually generates
-    a version called foobarbaz-<random stuff here>. This rips that
-    off.
+    kubectl is only run the first time this is called; use
+    _fetch_controller_name.cache_clear() to make it run again.
     """
-    return s.rsplit('-', 1)[0]
+    return run_command(['kubectl', 'get', 'rc', '-l', FRONTEND_SELECTOR,
+                        '-o', 'jsonpath={.items[0].metadata.name}'],
+                       echo=False).strip().decode('ascii')
 
 
-def get_pod_id():
-    """Return the current pod ID running on Google Cloud.
+def get_current_version():
+    """Return the (prefix, number) of the version running on Google Cloud.
 
-    For a given version with the name ABC, Google Cloud pod
-    IDs look like ABC-<random string>; this function will include
-    that.
+    The replication controller for a version is named ABC-vN, so this
+    just splits its name up; kubectl is asked for only that one field,
+    rather than a table of every pod.
     """
-    pods = run_command(['kubectl', 'get', 'pods'])
-    return POD_ID_MATCH.search(pods).group(0)
+    prefix, _, number = _fetch_controller_name().rpartition('-v')
+    return prefix, int(number)
 
 
-def increment_version(current_version):
+def increment_version(prefix, number):
     """Return the next version name."""
-    prefix, version = current_version.split('-')
-    return '%s-v%s' % (prefix, int(version[1:]) + 1)
+    return format_version(prefix, number + 1)
 
 
 def get_secret(filename, passphrase_id):
-    if not os.path.exists(filename):
-        print(u'Please create a “%s” file with secret %s in it.'
+    try:
+        fd = os.open(filename, os.O_RDONLY)
+    except FileNotFoundError:
+        print('Please create a “%s” file with secret %s in it.'
               % (filename, passphrase_id),
               file=sys.stderr)
-        exit(1)
-    return open(filename).read().strip()
+        sys.exit(1)
+    try:
+        return os.read(fd, READ_SIZE).strip()
+    finally:
+        os.close(fd)
 
 
-def run_command(command):
+def run_command(command, echo=True, input=None):
     """Run a subprocess command, but echoing as it goes.
 
+    Pass echo=False to run the command quietly, and input (bytes) to feed
+    it to the command's stdin.
+
     Returns all of the command output."""
-    process = subprocess.Popen(command, stdout=subprocess.PIPE)
-    output = StringIO.StringIO()
-    while True:
-        next_line = process.stdout.readline()
-        if next_line == '' and process.poll() is not None:
-            break
-        if next_line:
-            print(next_line.strip())
-            output.write(next_line)
-    rc = process.poll()
-    output = output.getvalue()
+    # Giving subprocess the full path to the executable, and leaving
+    # close_fds off (our own descriptors are non-inheritable anyway), lets
+    # it start the child with posix_spawn() instead of fork() + exec().
+    executable = shutil.which(command[0]) or command[0]
+    process = subprocess.Popen([executable] + command[1:],
+                               stdin=subprocess.PIPE if input else None,
+                               stdout=subprocess.PIPE, close_fds=False)
+    if input:
+        with process.stdin:
+            process.stdin.write(input)
+    fd = process.stdout.fileno()
+    output = bytearray()
+    for chunk in iter(functools.partial(os.read, fd, READ_SIZE), b''):
+        output += chunk
+        if echo:
+            sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
+    process.stdout.close()
+    rc = process.wait()
+    output = bytes(output)
     if rc:
         raise subprocess.CalledProcessError(returncode=rc, cmd=command,
                                             output=output)
     return output
 
 
-def deploy(current, new, slack_token, jenkins_api_token,
-           delete_desc_file=True):
-    """Deploy a new version of slacker-cow."""
-    template = open(FRONTEND_TEMPLATE, 'rb').read()
-    template = template.replace(VERSION_REPLACEMENT, new)
-    template = template.replace(SLACK_REPLACEMENT, slack_token)
-    template = template.replace(JENKINS_API_REPLACEMENT, jenkins_api_token)
-    with tempfile.NamedTemporaryFile(suffix='.json', delete=False)\
-            as kube_desc:
-        kube_desc.write(template)
-    try:
-        run_command(['kubectl',
-                     'rolling-update', current, '-f', kube_desc.name])
-    finally:
-        if delete_desc_file:
-            os.unlink(kube_desc.name)
+def _load_template():
+    """Return the frontend template, split up around its placeholders.
+
+    The result alternates between literal chunks of the template (at even
+    indices) and the placeholder strings found between them (at odd
+    indices), so filling it in needs no further scanning. The file is only
+    read and split again if its mtime or size has changed since the last
+    call.
+    """
+    stat = os.stat(FRONTEND_TEMPLATE)
+    key = (FRONTEND_TEMPLATE, stat.st_mtime_ns, stat.st_size)
+    if key not in _TEMPLATE_CACHE:
+        with open(FRONTEND_TEMPLATE, 'rb') as template_file:
+            _TEMPLATE_CACHE[key] = tuple(
+                SUBSTITUTION_MATCH.split(template_file.read()))
+    return _TEMPLATE_CACHE[key]
+
+
+def render_template(new, slack_token, jenkins_api_token):
+    """Return the frontend template filled in with the given values.
+
+    All of the values are bytes, as is the result, which is assembled with
+    a single join of the pre-split template pieces.
+    """
+    replacements = {
+        VERSION_REPLACEMENT: new,
+        SLACK_REPLACEMENT: slack_token,
+        JENKINS_API_REPLACEMENT: jenkins_api_token,
+    }
+    return b''.join(replacements[piece] if i % 2 else piece
+                    for i, piece in enumerate(_load_template()))
+
+
+def deploy(current, new, slack_token, jenkins_api_token):
+    """Deploy a new version of slacker-cow.
+
+    The filled-in template is piped straight to kubectl, so it (and the
+    secrets in it) never touch the disk.
+    """
+    run_command(['kubectl',
+                 'rolling-update', current, '-f', '-',
+                 '--update-period', UPDATE_PERIOD],
+                input=render_template(new.encode('ascii'), slack_token,
+                                      jenkins_api_token))
 
 
 def main():
-    rebuild_image()
-    pod_id = get_pod_id()
-    current_version = get_version(pod_id)
-    new_version = increment_version(current_version)
-    slack_token = get_secret(SLACK_TOKEN_FILE, "K88")
-    jenkins_api_token = get_secret(JENKINS_API_TOKEN_FILE, "K92")
+    # None of these depend on each other, so overlap them.
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        rebuild = executor.submit(rebuild_image)
+        secrets = executor.map(get_secret,
+                               [SLACK_TOKEN_FILE, JENKINS_API_TOKEN_FILE],
+                               ["K88", "K92"])
+        prefix, number = get_current_version()
+        current_version = format_version(prefix, number)
+        new_version = increment_version(prefix, number)
+        slack_token, jenkins_api_token = secrets
+        rebuild.result()
     deploy(current_version, new_version, slack_token, jenkins_api_token)
 
 if __name__ == '__main__':